@@ -1,8 +1,23 @@
-from typing import NamedTuple, List, Text
+import datetime
+from functools import lru_cache
+from typing import Callable, NamedTuple, List, Optional, Sequence, Text, Tuple, Union
 
 import numpy as np
 import pandas as pd
 
+try:
+    from numba import njit
+except ImportError:  # numba не обязателен, без него ядро worktime работает как обычная функция
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+_MIDNIGHT = np.timedelta64(0, 'ns')  # Время 00:00:00, с которым сравниваются столбцы начала и конца дня
+_DAY_NS = 86_400_000_000_000  # Число наносекунд в сутках
+_TIME_PATTERN = r'([01]?\d|2[0-3]):[0-5]\d:[0-5]\d'  # Время "ЧАС:МИНУТА:СЕКУНДА", которое понимает pd.to_timedelta
+_PANDAS_2 = int(pd.__version__.split('.')[0]) >= 2  # Форматы 'mixed' и 'ISO8601' в pd.to_datetime есть с pandas 2.0
+_MIXED_FORMAT = 'mixed' if _PANDAS_2 else None
+_ISO8601_FORMAT = 'ISO8601' if _PANDAS_2 else None
+
 
 class ScheduleDay(NamedTuple):
     """
@@ -20,6 +35,26 @@ class ScheduleDay(NamedTuple):
     is_work: bool  # Флаг рабочего дня
 
 
+def make_schedule_days(starts: Sequence[Text], ends: Sequence[Text], is_works: Sequence[bool],
+                       date_format: Optional[Text] = _ISO8601_FORMAT) -> List[ScheduleDay]:
+    """
+    Делает список ScheduleDay сразу из списков начал, концов и флагов рабочих дней.
+
+    :param starts: Начала дней в виде строк "ГОД-МЕСЯЦ-ДЕНЬ ЧАС:МИНУТА" или "ГОД-МЕСЯЦ-ДЕНЬ ЧАС:МИНУТА:СЕКУНДА"
+    :param ends: Концы дней в том же формате
+    :param is_works: Флаги рабочих дней
+    :param date_format: Формат строк для pd.to_datetime. По умолчанию ISO8601, он принимает время с секундами и без
+                        и разбирается быстро. Если указать None, то формат будет определен автоматически,
+                        на pandas < 2.0 формата ISO8601 нет и по умолчанию используется None
+    :return: Список из ScheduleDay
+    """
+    assert len(starts) == len(ends) == len(is_works), 'starts, ends and is_works must have the same length'
+
+    starts = pd.to_datetime(starts, format=date_format)
+    ends = pd.to_datetime(ends, format=date_format)
+    return [ScheduleDay(start, end, is_work) for start, end, is_work in zip(starts, ends, is_works)]
+
+
 def make_schedule_day(start: Text, end: Text, is_work: bool) -> ScheduleDay:
     """ Функция приведет к нужному типу start, end и сделает объект ScheduleDay """
     start = pd.Timestamp(start)
@@ -27,47 +62,189 @@ def make_schedule_day(start: Text, end: Text, is_work: bool) -> ScheduleDay:
     return ScheduleDay(start, end, is_work)
 
 
-def worktime(start: pd.Timestamp, end: pd.Timestamp, schedule: List[ScheduleDay]) -> pd.Timedelta:
+def build_schedule_arrays(schedule: List[ScheduleDay]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Возвращает число секунд между start и end вычитая нерабочее время из schedule.
+    Раскладывает расписание на три параллельных массива, отсортированных по началу рабочего дня:
+        1. Начало дня в наносекундах с начала эпохи (int64)
+        2. Конец дня в наносекундах с начала эпохи (int64)
+        3. Флаг рабочего дня (bool)
+
+    .. note::
+        Дни в расписании не должны пересекаться, тогда после сортировки по началу дня концы дней тоже отсортированы.
 
-    :param start: Дата и время начала какого-то события
-    :param end: Дата и время конца какого-то события
     :param schedule: Список из дней (кортеж с началом, концом и флагом рабочего дня)
-    :return: pd.Timedelta, который можно преобразовать к секундам с помощью метода атрибута seconds
+    :return: Кортеж из массивов start_ns, end_ns, is_work
     """
+    start_ns = np.fromiter((day.start.value for day in schedule), dtype=np.int64, count=len(schedule))
+    end_ns = np.fromiter((day.end.value for day in schedule), dtype=np.int64, count=len(schedule))
+    is_work = np.fromiter((day.is_work for day in schedule), dtype=np.bool_, count=len(schedule))
+
+    order = np.argsort(start_ns, kind='stable')  # Отсортируем расписание по началу рабочего дня
+    return start_ns[order], end_ns[order], is_work[order]
 
+
+class CompiledSchedule(NamedTuple):
+    """
+    Расписание, подготовленное для многократных вызовов worktime. Создается функцией compile_schedule.
+
+    .. note::
+        cum_work_ns[i] - суммарное рабочее время первых i дней расписания, поэтому рабочее время дней с i по j - 1
+        равно cum_work_ns[j] - cum_work_ns[i].
+
+    """
+    start_ns: np.ndarray  # Начала дней в наносекундах, отсортированы по возрастанию
+    end_ns: np.ndarray  # Концы дней в наносекундах
+    is_work: np.ndarray  # Флаги рабочих дней
+    cum_work_ns: np.ndarray  # Префиксные суммы рабочего времени, длина на единицу больше числа дней
+    tz: Optional[datetime.tzinfo]  # Часовой пояс расписания, None если дни заданы без него
+
+
+def compile_schedule(schedule: List[ScheduleDay]) -> CompiledSchedule:
+    """
+    Сортирует расписание и считает префиксные суммы рабочего времени. Если worktime вызывается много раз с одним и тем
+    же расписанием, то его стоит подготовить один раз и передавать в worktime результат этой функции.
+
+    :param schedule: Список из дней (кортеж с началом, концом и флагом рабочего дня)
+    :return: CompiledSchedule
+    """
     assert isinstance(schedule, List), 'type schedule must be list'
     assert isinstance(schedule[0], ScheduleDay), 'type of days must be ScheduleDay'
-    assert start <= end, 'timestamp 1 (start) must not be later than timestamp 2 (end)'
 
-    schedule.sort(key=lambda x: x.start)  # Отсортируем расписание по началу рабочего дня
+    start_ns, end_ns, is_work = build_schedule_arrays(schedule)
+    assert np.all(end_ns[:-1] <= start_ns[1:]), 'days in schedule must not overlap'
+    cum_work_ns = np.concatenate([[0], np.cumsum(np.where(is_work, end_ns - start_ns, 0))]).astype(np.int64)
+    return CompiledSchedule(start_ns, end_ns, is_work, cum_work_ns, schedule[0].start.tz)
 
-    # Оставим из расписания определенные дни. Начало рабочего дня должно быть меньше второй временной метки
-    # Конец рабочего дня должен быть больше первой временной метки.
-    schedule = list(filter(lambda x: x.start <= end and start <= x.end, schedule))
 
-    total_time = pd.Timedelta(0)
-    if len(schedule) == 1:
-        if start.date() == end.date():  # Если две временные отметки в одних сутках, то возвращает просто их разность
-            return end - start
+def _check_timezone(start: pd.Timestamp, end: pd.Timestamp, tz: Optional[datetime.tzinfo]) -> None:
+    """ Отметки и расписание должны быть либо все с часовым поясом, либо все без него """
+    assert (start.tz is None) == (end.tz is None) == (tz is None), \
+        'start, end and schedule must be all tz-naive or all tz-aware'
+
+
+def _utc_offset_ns(timestamp: pd.Timestamp) -> int:
+    """ Смещение временной метки от UTC в наносекундах, для меток без часового пояса 0 """
+    offset = timestamp.utcoffset()
+    return 0 if offset is None else pd.Timedelta(offset).value
+
+
+@njit(cache=True)
+def _worktime_core(start_ns, end_ns, is_work, cum_work_ns, q_start, q_end, start_offset, end_offset):
+    """
+    Считает рабочее время между q_start и q_end в наносекундах по массивам из CompiledSchedule.
+    q_start и q_end заданы в UTC, start_offset и end_offset - их смещения от UTC, чтобы сравнивать местные даты.
+    Время копится в целом числе наносекунд, pd.Timedelta из него создает уже вызывающая функция.
+    Если установлен numba, то функция компилируется при первом вызове.
+    """
+    # Оставим из расписания определенные дни. Начало рабочего дня должно быть меньше второй временной метки
+    # Конец рабочего дня должен быть больше первой временной метки. Так как дни не пересекаются, то оба массива
+    # отсортированы и подходящие дни образуют срез [lo, hi), который находим бинарным поиском.
+    lo = np.searchsorted(end_ns, q_start, side='left')
+    hi = np.searchsorted(start_ns, q_end, side='right')
+
+    if hi <= lo:  # Между отметками нет ни одного дня из расписания, значит рабочего времени нет
+        return 0
+
+    if hi - lo == 1:
+        # Если две временные отметки в одних сутках, то возвращает просто их разность
+        if (q_start + start_offset) // _DAY_NS == (q_end + end_offset) // _DAY_NS:
+            return int(q_end - q_start)
         # Если даты разные, но при этом рабочий день один, то есть работник закончил позднее 00:00, но раньше, чем
         # начался следующий рабочий день по расписанию, то находим время от первой отметки до конца рабочего дня
-        else:
-            return schedule[0].end - start
+        return int(end_ns[lo] - q_start)
 
-    if len(schedule) > 2:  # Суммируем все целые рабочие дни
-        for day in schedule[1:-1]:  # между датами
-            if day.is_work:  # Проверяем, что день рабочий
-                total_time += day.end - day.start
-            schedule.remove(day)
+    # Суммируем все целые рабочие дни между датами с помощью префиксных сумм
+    total_ns = int(cum_work_ns[hi - 1] - cum_work_ns[lo + 1])
 
-    if schedule[0].is_work:
-        total_time += schedule[0].end - start  # Прибавляем рабочее время в первый РАБОЧИЙ день
-    if schedule[1].is_work:
-        total_time += end - schedule[1].start  # Прибавляет время в последний РАБОЧИЙ день
+    if is_work[lo]:
+        total_ns += int(end_ns[lo] - q_start)  # Прибавляем рабочее время в первый РАБОЧИЙ день
+    if is_work[hi - 1]:
+        total_ns += int(q_end - start_ns[hi - 1])  # Прибавляет время в последний РАБОЧИЙ день
 
-    return total_time
+    return total_ns
+
+
+def worktime(start: pd.Timestamp, end: pd.Timestamp,
+             schedule: Union[List[ScheduleDay], CompiledSchedule]) -> pd.Timedelta:
+    """
+    Возвращает число секунд между start и end вычитая нерабочее время из schedule.
+
+    :param start: Дата и время начала какого-то события, pd.Timestamp или datetime.datetime
+    :param end: Дата и время конца какого-то события
+    :param schedule: Список из дней (кортеж с началом, концом и флагом рабочего дня) или результат compile_schedule
+    :return: pd.Timedelta, который можно преобразовать к секундам с помощью метода атрибута seconds
+
+    .. note::
+        Список schedule не изменяется, но на каждый вызов он заново подготавливается: три прохода Python по
+        объектам pd.Timestamp (np.fromiter), сортировка за O(N log N) и проверка, что дни не пересекаются.
+        Для вызовов в цикле один раз вызовите make_worktime (или compile_schedule) и пользуйтесь результатом,
+        тогда каждый вызов стоит O(log N).
+    """
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    assert start <= end, 'timestamp 1 (start) must not be later than timestamp 2 (end)'
+
+    if not isinstance(schedule, CompiledSchedule):
+        schedule = compile_schedule(schedule)
+    _check_timezone(start, end, schedule.tz)
+
+    total_ns = _worktime_core(schedule.start_ns, schedule.end_ns, schedule.is_work, schedule.cum_work_ns,
+                              start.value, end.value, _utc_offset_ns(start), _utc_offset_ns(end))
+    return pd.Timedelta(total_ns)
+
+
+def make_worktime(schedule: Union[List[ScheduleDay], CompiledSchedule]
+                  ) -> Callable[[pd.Timestamp, pd.Timestamp], pd.Timedelta]:
+    """
+    Возвращает функцию worktime с зафиксированным расписанием, которая принимает только start и end.
+    Расписание подготавливается один раз, а ответы для повторяющихся пар (start, end) кэшируются,
+    поэтому так удобнее считать рабочее время для множества событий.
+
+    :param schedule: Список из дней (кортеж с началом, концом и флагом рабочего дня) или результат compile_schedule
+    :return: Функция (start, end) -> pd.Timedelta
+    """
+    if not isinstance(schedule, CompiledSchedule):
+        schedule = compile_schedule(schedule)
+    start_ns, end_ns, is_work, cum_work_ns, tz = schedule
+
+    @lru_cache(maxsize=4096)
+    def worktime_ns(start_value: int, end_value: int, start_offset: int, end_offset: int) -> int:
+        """ Запоминает ответы для повторяющихся пар отметок в наносекундах """
+        return _worktime_core(start_ns, end_ns, is_work, cum_work_ns, start_value, end_value, start_offset, end_offset)
+
+    def schedule_worktime(start: pd.Timestamp, end: pd.Timestamp) -> pd.Timedelta:
+        """ Возвращает рабочее время между start и end по зафиксированному расписанию """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        assert start <= end, 'timestamp 1 (start) must not be later than timestamp 2 (end)'
+        _check_timezone(start, end, tz)
+        return pd.Timedelta(worktime_ns(start.value, end.value, _utc_offset_ns(start), _utc_offset_ns(end)))
+
+    return schedule_worktime
+
+
+def _parse_time(times: pd.Series, day: np.ndarray) -> np.ndarray:
+    """
+    Переводит столбец со временем дня в массив timedelta64[ns] от начала суток day, пропуски остаются NaT.
+    Время вида "ЧАС:МИНУТА:СЕКУНДА" разбирается сразу для всего столбца, остальные записи ("9:00", "9:00 AM", "09")
+    разбираются вместе с датой так же, как их понимает pd.Timestamp, поэтому некорректное время вызывает ошибку.
+    """
+    times = times.reset_index(drop=True)
+    notna = times.notna().to_numpy()
+    delta = np.full(len(times), np.timedelta64('NaT'), dtype='timedelta64[ns]')
+    if not notna.any():  # Столбец целиком из пропусков может быть числовым, у него нет .str
+        return delta
+    if pd.api.types.infer_dtype(times[notna], skipna=True) != 'string':
+        raise TypeError('Время начала и конца рабочего дня должно быть задано строкой')
+
+    simple = times.str.fullmatch(_TIME_PATTERN, na=False).to_numpy()
+    delta[simple] = pd.to_timedelta(times[simple]).to_numpy().astype('timedelta64[ns]')
+
+    other = notna & ~simple
+    if other.any():
+        text = pd.Series(day[other]).dt.strftime('%Y-%m-%d') + ' ' + times[other].to_numpy()
+        parsed = pd.to_datetime(text, format=_MIXED_FORMAT).to_numpy().astype('datetime64[ns]')
+        delta[other] = parsed - day[other]
+    return delta
 
 
 def convert_data(data: pd.DataFrame, day_col_name: Text = 'day', start_time_col_name: Text = 'start_time',
@@ -76,7 +253,7 @@ def convert_data(data: pd.DataFrame, day_col_name: Text = 'day', start_time_col_
     """
     Возвращает список из объектов ScheduleDay. На вход принимает датасет, в котором есть столбцы со значениями:
         1. День в формате даты без времени "ГОД-МЕСЯЦ-ДЕНЬ". Данные в столбце должен быть в формате datetime64[ns]
-        2. Время начала и конца рабочего дня, строковые данные.
+        2. Время начала и конца рабочего дня, строковые данные, например "09:00:00", "9:00" или "9:00 AM".
         3. Флаг рабочего дня, True если день - рабочий, иначе False
 
     .. note::
@@ -98,52 +275,33 @@ def convert_data(data: pd.DataFrame, day_col_name: Text = 'day', start_time_col_
                  Типы в столбцах обязательно такие как описаны выше.
     """
     data = data[[day_col_name, start_time_col_name, end_time_col_name, is_work_col_name]]
-    assert data.isna().sum(axis=0)[day_col_name] == 0, 'Столбец дня должен быть без пропусков'
-    assert data.isna().sum(axis=0)[is_work_col_name] == 0, 'Столбец флага рабочего дня должен быть без пропусков'
-
-    def convert_raw(raw: pd.Series) -> ScheduleDay:
-        """Заполняет пропуски во времени. Выходные значениями 00:00:00, Будни с помощью default значений"""
-        if not raw[is_work_col_name]:  # Работаем с выходным
-            # Если оба значения пропущены, то заполняем нулями
-            if np.all(pd.isna(raw[[start_time_col_name, end_time_col_name]])):
-                raw = raw.fillna('00:00:00')
-
-            # Если начало пропущено, а конец нет, проверим конец на значение 00:00 и заполним
-            elif pd.isna(raw[start_time_col_name]) and pd.notna(raw[end_time_col_name]):
-                if pd.Timestamp(raw[end_time_col_name]) == pd.Timestamp('00:00:00'):
-                    raw = raw.fillna('00:00:00')
-                else:
-                    raw[start_time_col_name] = start_time_default
-                    raw[is_work_col_name] = True
-
-            # Наоборот проверим конец и начало
-            elif pd.isna(raw[end_time_col_name]) and pd.notna(raw[start_time_col_name]):
-                if pd.Timestamp(raw[start_time_col_name]) == pd.Timestamp('00:00:00'):
-                    raw = raw.fillna('00:00:00')
-                else:
-                    raw[end_time_col_name] = end_time_default
-                    raw[is_work_col_name] = True
-
-            # Если оба значения не пропущены, то проверим, что они оба 00:00:00, если нет, то день рабочий
-            else:
-                if (pd.Timestamp(raw[start_time_col_name]) != pd.Timestamp('00:00:00') or
-                        pd.Timestamp(raw[end_time_col_name]) != pd.Timestamp('00:00:00')):
-                    raw[is_work_col_name] = True
-
-        else:  # Заполним рабочий день
-            if pd.isna(raw[start_time_col_name]):
-                raw[start_time_col_name] = start_time_default
-            if pd.isna(raw[end_time_col_name]):
-                raw[end_time_col_name] = end_time_default
-
-        # Приводим к корректному времени и создаем ScheduleDay
-        start_datetime = pd.Timestamp(raw[day_col_name].strftime('%Y-%m-%d') + ' ' + raw[start_time_col_name])
-        end_datetime = pd.Timestamp(raw[day_col_name].strftime('%Y-%m-%d') + ' ' + raw[end_time_col_name])
-
-        return ScheduleDay(start_datetime, end_datetime, raw[is_work_col_name])
-
-    data = data.apply(convert_raw, axis=1)
-    return data.to_list()
+    assert not data[day_col_name].isna().any(), 'Столбец дня должен быть без пропусков'
+    assert not data[is_work_col_name].isna().any(), 'Столбец флага рабочего дня должен быть без пропусков'
+
+    is_work = data[is_work_col_name].to_numpy(dtype=bool)
+    day = data[day_col_name].to_numpy().astype('datetime64[D]').astype('datetime64[ns]')
+    default_day = np.array(['2000-01-01'], dtype='datetime64[ns]')
+    default_start = _parse_time(pd.Series([start_time_default]), default_day)[0]
+    default_end = _parse_time(pd.Series([end_time_default]), default_day)[0]
+
+    # Разбираем время один раз для всего столбца, по нему же считаем маски пропусков и значений 00:00:00
+    start_delta = _parse_time(data[start_time_col_name], day)
+    end_delta = _parse_time(data[end_time_col_name], day)
+    start_na, end_na = np.isnat(start_delta), np.isnat(end_delta)
+    start_zero, end_zero = start_delta == _MIDNIGHT, end_delta == _MIDNIGHT
+
+    # Выходной, в котором есть время начала или конца, отличное от 00:00:00, считается рабочим
+    is_work = is_work | (~start_na & ~start_zero) | (~end_na & ~end_zero)
+
+    # Пропуски в рабочие дни заполняем default значениями, в выходные - 00:00:00
+    start_delta = np.where(start_na, np.where(is_work, default_start, _MIDNIGHT), start_delta)
+    end_delta = np.where(end_na, np.where(is_work, default_end, _MIDNIGHT), end_delta)
+
+    # Приводим к корректному времени: к началу суток прибавляем время дня, и создаем ScheduleDay
+    start_datetime = pd.DatetimeIndex(day + start_delta)
+    end_datetime = pd.DatetimeIndex(day + end_delta)
+
+    return [ScheduleDay(start, end, work) for start, end, work in zip(start_datetime, end_datetime, is_work.tolist())]
 
 
 if __name__ == '__main__':
@@ -155,8 +313,9 @@ if __name__ == '__main__':
     #                              dtype={'Начало рабочего дня': str, 'Конец рабочего дня': str})
     # data_raw = pd.read_excel('test/worktime-test-example.xlsx', sheet_name='Случаи')
     # sch = convert_data(schedule_raw, 'День', 'Начало рабочего дня', 'Конец рабочего дня', 'Рабочий день')
+    # sch_worktime = make_worktime(sch)
     # for i in range(data_raw.shape[0]):
-    #     dt = worktime(data_raw.loc[i, 'Степ 1'], data_raw.loc[i, 'Степ 2'], sch)
+    #     dt = sch_worktime(data_raw.loc[i, 'Степ 1'], data_raw.loc[i, 'Степ 2'])
     #     data_raw.loc[i, 'Рабочее время в секундах'] = dt
 
     # Проверка на данных для разработки